@@ -0,0 +1,38 @@
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    # Numba is optional: without it the kernels run as plain Python
+    def njit(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+BIN_WIDTH = 10   # BPM per histogram bin
+N_BINS = 30      # 0–299 BPM
+BPM_LIMIT = BIN_WIDTH * N_BINS   # readings at or above this are not counted
+
+
+def new_bins() -> np.ndarray:
+    return np.zeros(N_BINS, dtype=np.int64)
+
+
+@njit(cache=True)
+def update_bins(bins: np.ndarray, bpm: int, best: int) -> int:
+    """Count bpm in its bin and return the index of the most common bin (-1 = none yet).
+
+    Out-of-range bpm leaves the histogram unchanged.
+    """
+    idx = bpm // BIN_WIDTH
+    if idx >= bins.shape[0]:
+        return best
+    bins[idx] += 1
+    if best < 0 or bins[idx] > bins[best]:
+        return idx
+    return best
+
+
+def warm_up() -> None:
+    """Compile the kernels on a dummy input so the first real sample doesn't pay for the JIT."""
+    update_bins(new_bins(), 60, -1)
@@ -1,14 +1,17 @@
 import asyncio
-import csv
+import queue
 import sys
+import threading
 import time
-from dataclasses import dataclass
+from collections import deque
 from datetime import datetime
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Optional
 
+import numpy as np
 import pyqtgraph as pg
-from PySide6.QtCore import Qt, Signal, QSettings
+from PySide6.QtCore import Qt, Signal, QSettings, QTimer
+from PySide6.QtGui import QSurfaceFormat
 from PySide6.QtWidgets import (
     QApplication,
     QComboBox,
@@ -27,15 +30,25 @@ from qasync import QEventLoop, asyncSlot
 from bleak import BleakClient
 
 # Берём BLE-логику из src/h64_logger.py (он лежит рядом, в той же папке src)
-from h64_logger import HR_SERVICE, HR_CHAR, BAT_CHAR, parse_hr, scan, service_uuids_lower
+from h64_logger import (
+    HR_CHAR,
+    BAT_CHAR,
+    CSV_HEADER,
+    IsoSecondFormatter,
+    has_hr_service,
+    parse_hr,
+    scan,
+)
+import h64_analytics
 
 WINDOW_SEC = 60.0
-
-
-@dataclass
-class Sample:
-    t: float   # epoch seconds
-    bpm: int
+WINDOW_MAXLEN = 4096   # ring buffer capacity (points kept in the plot window)
+RENDER_INTERVAL_MS = 33   # ~30 Hz plot refresh, independent of the sample rate
+LOG_FLUSH_ROWS = 32       # CSV writer flushes after this many rows...
+LOG_FLUSH_SEC = 1.0       # ...or after this many seconds, whichever comes first
+MAX_POINTS_PER_PIXEL = 2  # decimate the curve above this many points per horizontal pixel
+XRANGE_MIN_STEP_SEC = 0.1   # scroll the x window at most ~10 times per second
+YRANGE_HYSTERESIS_BPM = 3   # keep the y range until a bound moves by more than this
 
 
 def default_out_path() -> Path:
@@ -43,8 +56,92 @@ def default_out_path() -> Path:
     return Path("logs") / f"h64_hr_log_{ts}.csv"
 
 
+def configure_plot_backend() -> bool:
+    """Use pyqtgraph's OpenGL path if PyOpenGL is installed. Must run before QApplication."""
+    try:
+        import OpenGL  # noqa: F401
+    except ImportError:
+        pg.setConfigOptions(antialias=True)
+        return False
+
+    # MSAA on the GL surface replaces QPainter antialiasing
+    fmt = QSurfaceFormat()
+    fmt.setSamples(4)
+    QSurfaceFormat.setDefaultFormat(fmt)
+    pg.setConfigOptions(useOpenGL=True, enableExperimental=True, antialias=False)
+    return True
+
+
+def peak_decimate(xs: np.ndarray, ys: np.ndarray, n_buckets: int) -> tuple[np.ndarray, np.ndarray]:
+    """Keep the min and max sample of each of ~n_buckets equal chunks (time order preserved)."""
+    n = len(ys)
+    k = -(-n // n_buckets)   # samples per bucket, rounded up
+    m = n - n % k
+    base = np.arange(0, m, k)
+    chunks = ys[:m].reshape(-1, k)
+    idx = np.unique(np.concatenate((
+        base + chunks.argmin(axis=1),
+        base + chunks.argmax(axis=1),
+        np.arange(m, n),   # short last chunk is kept as is
+    )))
+    return xs[idx], ys[idx]
+
+
+class CsvLogWriter:
+    """CSV log (append if the file exists) written by a background thread, so disk I/O stays off the UI loop."""
+
+    def __init__(self, path: Path, on_error: Callable[[str], None]):
+        self._on_error = on_error
+        self._failed = False
+        existed = path.exists() and path.stat().st_size > 0
+        self._file = open(path, "a" if existed else "w", newline="", encoding="utf-8", buffering=1 << 16)
+        if not existed:
+            self._file.write(CSV_HEADER)
+
+        self._q: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="csv-log-writer", daemon=True)
+        self._thread.start()
+
+    def put(self, row: tuple) -> None:
+        if not self._failed:   # writer thread is gone, don't grow the queue
+            self._q.put_nowait(row)
+
+    def close(self) -> None:
+        """Write out queued rows, stop the thread and close the file."""
+        self._q.put(None)
+        self._thread.join()
+        self._file.close()
+
+    def _run(self):
+        try:
+            self._write_loop()
+        except Exception as e:
+            self._failed = True
+            self._on_error(f"log write error: {e}")
+
+    def _write_loop(self):
+        unflushed = 0
+        last_flush = time.monotonic()
+        while True:
+            try:
+                row = self._q.get(timeout=LOG_FLUSH_SEC)
+            except queue.Empty:
+                pass
+            else:
+                if row is None:
+                    break
+                ts, bpm, battery = row
+                self._file.write(f"{ts},{bpm},{battery}\r\n")
+                unflushed += 1
+
+            now = time.monotonic()
+            if unflushed and (unflushed >= LOG_FLUSH_ROWS or now - last_flush >= LOG_FLUSH_SEC):
+                self._file.flush()
+                unflushed = 0
+                last_flush = now
+
+
 class MainWindow(QMainWindow):
-    sample_signal = Signal(float, int)   # (timestamp, bpm)
     battery_signal = Signal(int)
     status_signal = Signal(str)
 
@@ -55,6 +152,7 @@ class MainWindow(QMainWindow):
 
         # ---- persistent settings ----
         self.settings = QSettings("ArtemDenisovQA", "H64HeartRatePythonGUI")
+        self.saved_address: str = (self.settings.value("last_address", "") or "").strip()
 
         # ---- BLE state ----
         self.client: Optional[BleakClient] = None
@@ -69,14 +167,32 @@ class MainWindow(QMainWindow):
 
         # ---- logging state ----
         self.log_path: Path = default_out_path()
-        self.log_file = None
-        self.log_writer = None
+        self.log_writer: Optional[CsvLogWriter] = None
+        self._iso = IsoSecondFormatter()
 
         # ---- plot state ----
-        self.samples: list[Sample] = []
-        self.bin_counts: dict[int, int] = {}
+        self._cap = WINDOW_MAXLEN
+        self._ts_buf = np.empty(self._cap, dtype=np.float64)    # epoch seconds
+        self._bpm_buf = np.empty(self._cap, dtype=np.float64)
+        self._seq = 0     # samples written since connect; slot of sample i is i % _cap
+        self._count = 0   # window samples, ending just before _seq
+        # contiguous copy of the window handed to setData
+        self._xs = np.empty(self._cap, dtype=np.float64)
+        self._ys = np.empty(self._cap, dtype=np.float64)
+        self._last_xrange_t = 0.0
+        self._last_yrange = (0.0, 0.0)
+        # monotonic queues of sample numbers -> window min/max in O(1)
+        self._min_dq: deque[int] = deque()
+        self._max_dq: deque[int] = deque()
+        self._bins = h64_analytics.new_bins()   # 10-BPM histogram since connect
+        self._best_bin = -1                     # index into _bins, -1 = no samples yet
         self.total_samples = 0
 
+        # ---- incoming samples (filled by on_hr, drained by _render) ----
+        self._pending_lock = threading.Lock()
+        self._pending_ts: list[float] = []
+        self._pending_bpm: list[int] = []
+
         # ---- UI ----
         central = QWidget()
         self.setCentralWidget(central)
@@ -91,9 +207,8 @@ class MainWindow(QMainWindow):
         self.address_edit = QLineEdit()
         self.address_edit.setPlaceholderText("Address (UUID). Можно подключаться без Scan.")
 
-        saved_addr = (self.settings.value("last_address", "") or "").strip()
-        if saved_addr:
-            self.address_edit.setText(saved_addr)
+        if self.saved_address:
+            self.address_edit.setText(self.saved_address)
 
         self.scan_timeout = QSpinBox()
         self.scan_timeout.setRange(3, 60)
@@ -148,13 +263,20 @@ class MainWindow(QMainWindow):
         self.plot.setLabel("left", "BPM")
         self.plot.setLabel("bottom", "Time")
         self.plot.showGrid(x=True, y=True, alpha=0.25)
-        self.curve = self.plot.plot([], [])
+        # data is always finite and time-ordered: skip pyqtgraph's NaN pass, drop off-screen points
+        self.curve = self.plot.plot(
+            [],
+            [],
+            pen=pg.mkPen(width=1),
+            skipFiniteCheck=True,
+            clipToView=True,
+        )
         root.addWidget(self.plot, 1)
 
         # ---- Signals ----
-        self.sample_signal.connect(self._on_sample_ui)
-        self.battery_signal.connect(self._on_battery_ui)
-        self.status_signal.connect(self._on_status_ui)
+        # queued: bleak may call back from its own thread; emit just posts an event
+        self.battery_signal.connect(self._on_battery_ui, Qt.QueuedConnection)
+        self.status_signal.connect(self._on_status_ui, Qt.QueuedConnection)
 
         # ---- Buttons ----
         self.btn_scan.clicked.connect(self.on_scan_clicked)
@@ -162,6 +284,12 @@ class MainWindow(QMainWindow):
         self.btn_disconnect.clicked.connect(self.on_disconnect_clicked)
         self.btn_choose_log.clicked.connect(self.on_choose_log)
 
+        # ---- Render timer (coalesces samples into one redraw per frame) ----
+        self._render_timer = QTimer(self)
+        self._render_timer.setInterval(RENDER_INTERVAL_MS)
+        self._render_timer.timeout.connect(self._render)
+        self._render_timer.start()
+
     # ---------------- UI slots ----------------
 
     def _on_status_ui(self, text: str):
@@ -170,49 +298,107 @@ class MainWindow(QMainWindow):
     def _on_battery_ui(self, percent: int):
         self.battery_lbl.setText(f"Battery: {percent}%")
 
-    def _on_sample_ui(self, ts: float, bpm: int):
-        self.bpm_lbl.setText(f"BPM: {bpm}")
+    def _render(self):
+        with self._pending_lock:
+            if not self._pending_ts:
+                return
+            pending_ts, self._pending_ts = self._pending_ts, []
+            pending_bpm, self._pending_bpm = self._pending_bpm, []
 
-        # keep last WINDOW_SEC seconds
-        self.samples.append(Sample(t=ts, bpm=bpm))
+        for ts, bpm in zip(pending_ts, pending_bpm):
+            self._ingest_sample(ts, bpm)
+
+        ts = pending_ts[-1]
         start = ts - WINDOW_SEC
-        self.samples = [s for s in self.samples if s.t >= start]
+        self.bpm_lbl.setText(f"BPM: {pending_bpm[-1]}")
 
-        xs = [s.t for s in self.samples]   # epoch seconds -> DateAxisItem shows real time
-        ys = [s.bpm for s in self.samples]
-        self.curve.setData(xs, ys)
+        n = self._copy_window()
+        xs, ys = self._xs[:n], self._ys[:n]   # epoch seconds -> DateAxisItem shows real time
+        width = max(1, self.plot.width())
+        if n > MAX_POINTS_PER_PIXEL * width:
+            xs, ys = peak_decimate(xs, ys, width)
+        self.curve.setData(xs, ys, connect="all")
 
         # x window follows "now"
-        self.plot.setXRange(start, ts, padding=0)
+        if ts - self._last_xrange_t >= XRANGE_MIN_STEP_SEC:
+            self.plot.setXRange(start, ts, padding=0)
+            self._last_xrange_t = ts
 
         # auto-scale Y (not flat)
-        if ys:
-            ymin = min(ys)
-            ymax = max(ys)
-            if ymin == ymax:
-                ymin -= 5
-                ymax += 5
-            pad = max(3, int((ymax - ymin) * 0.15))
-            self.plot.setYRange(ymin - pad, ymax + pad)
+        ymin = self._bpm_buf[self._min_dq[0] % self._cap]
+        ymax = self._bpm_buf[self._max_dq[0] % self._cap]
+        if ymin == ymax:
+            ymin -= 5
+            ymax += 5
+        pad = max(3, int((ymax - ymin) * 0.15))
+        lo, hi = ymin - pad, ymax + pad
+        last_lo, last_hi = self._last_yrange
+        if abs(lo - last_lo) > YRANGE_HYSTERESIS_BPM or abs(hi - last_hi) > YRANGE_HYSTERESIS_BPM:
+            self.plot.setYRange(lo, hi)
+            self._last_yrange = (lo, hi)
+
+        if self._best_bin >= 0:
+            best_bin = self._best_bin * h64_analytics.BIN_WIDTH
+            pct = (int(self._bins[self._best_bin]) / max(1, self.total_samples)) * 100.0
+            self.range_lbl.setText(f"Most common 10-range: {best_bin}–{best_bin+9} ({pct:.1f}%)")
+
+    def _copy_window(self) -> int:
+        """Copy the ring buffer window into _xs/_ys (oldest first), return its length."""
+        n = self._count
+        head = self._seq % self._cap
+        tail = head - n
+        if tail >= 0:
+            self._xs[:n] = self._ts_buf[tail:head]
+            self._ys[:n] = self._bpm_buf[tail:head]
+        else:
+            # window wraps around the end of the buffer
+            k = -tail
+            self._xs[:k] = self._ts_buf[tail:]
+            self._ys[:k] = self._bpm_buf[tail:]
+            self._xs[k:n] = self._ts_buf[:head]
+            self._ys[k:n] = self._bpm_buf[:head]
+        return n
+
+    def _ingest_sample(self, ts: float, bpm: int):
+        # keep last WINDOW_SEC seconds
+        seq = self._seq
+        slot = seq % self._cap
+        self._ts_buf[slot] = ts
+        self._bpm_buf[slot] = bpm
+        self._seq = seq + 1
+        self._count = min(self._count + 1, self._cap)
+        start = ts - WINDOW_SEC
+        while self._count and self._ts_buf[(self._seq - self._count) % self._cap] < start:
+            self._count -= 1
+        oldest = self._seq - self._count
+
+        # sliding window min/max: pop dominated tails, then expired heads
+        bpm_buf, cap = self._bpm_buf, self._cap
+        while self._min_dq and bpm_buf[self._min_dq[-1] % cap] >= bpm:
+            self._min_dq.pop()
+        self._min_dq.append(seq)
+        while self._max_dq and bpm_buf[self._max_dq[-1] % cap] <= bpm:
+            self._max_dq.pop()
+        self._max_dq.append(seq)
+        while self._min_dq[0] < oldest:
+            self._min_dq.popleft()
+        while self._max_dq[0] < oldest:
+            self._max_dq.popleft()
 
         # update “most common 10-bpm range since connect”
-        b0 = (bpm // 10) * 10
-        self.bin_counts[b0] = self.bin_counts.get(b0, 0) + 1
-        self.total_samples += 1
-        best_bin = max(self.bin_counts.items(), key=lambda kv: kv[1])[0]
-        best_cnt = self.bin_counts[best_bin]
-        pct = (best_cnt / max(1, self.total_samples)) * 100.0
-        self.range_lbl.setText(f"Most common 10-range: {best_bin}–{best_bin+9} ({pct:.1f}%)")
-
-        # write to CSV
-        self._write_log_row(bpm)
-
-    def _write_log_row(self, bpm: int):
+        # readings outside the histogram (e.g. a garbled uint16) are not counted
+        if bpm < h64_analytics.BPM_LIMIT:
+            self._best_bin = h64_analytics.update_bins(self._bins, bpm, self._best_bin)
+            self.total_samples += 1
+
+        # write to CSV (same timestamp as the plotted point)
+        self._write_log_row(ts, bpm)
+
+    def _write_log_row(self, ts: float, bpm: int):
         if not self.log_writer:
             return
-        ts = datetime.now().isoformat(timespec="seconds")
-        self.log_writer.writerow([ts, bpm, "" if self.battery is None else self.battery])
-        self.log_file.flush()
+        iso = self._iso.format(ts)
+        self.log_writer.put((iso, bpm, "" if self.battery is None else self.battery))
 
     def on_choose_log(self):
         path, _ = QFileDialog.getSaveFileName(
@@ -245,8 +431,7 @@ class MainWindow(QMainWindow):
         candidates: list[tuple[int, str, str]] = []
 
         for addr, (dev, adv) in found.items():
-            uuids = service_uuids_lower(adv)
-            if HR_SERVICE not in uuids:
+            if not has_hr_service(adv):
                 continue
 
             name = (dev.name or "").strip()
@@ -356,7 +541,9 @@ class MainWindow(QMainWindow):
             if bpm is None:
                 return
             ts = time.time()
-            self.sample_signal.emit(ts, bpm)
+            with self._pending_lock:
+                self._pending_ts.append(ts)
+                self._pending_bpm.append(bpm)
 
         try:
             await self.client.start_notify(HR_CHAR, on_hr)
@@ -382,26 +569,22 @@ class MainWindow(QMainWindow):
             self.status_signal.emit(f"scan error: {e}")
             return
 
-        items = []
-        for addr, (dev, adv) in found.items():
-            uuids = service_uuids_lower(adv)
-            is_hr = (HR_SERVICE in uuids)
-            name = dev.name or ""
-            title = f"{name} ({addr})"
-            items.append((0 if is_hr else 1, title, addr))
-
-        items.sort(key=lambda x: (x[0], x[1]))
+        # HR devices first, then by title (titles embed the address, so they are unique)
+        items = sorted(
+            (not has_hr_service(adv), f"{dev.name or ''} ({addr})", addr)
+            for addr, (dev, adv) in found.items()
+        )
 
-        for _, title, addr in items:
+        idx_by_addr: dict[str, int] = {}
+        for i, (_, title, addr) in enumerate(items):
             self.device_combo.addItem(title, userData=addr)
+            idx_by_addr[addr.lower()] = i
 
         # if saved address exists and present -> select it
-        saved = (self.settings.value("last_address", "") or "").strip()
-        if saved:
-            for i in range(self.device_combo.count()):
-                if (self.device_combo.itemData(i) or "").lower() == saved.lower():
-                    self.device_combo.setCurrentIndex(i)
-                    break
+        if self.saved_address:
+            i = idx_by_addr.get(self.saved_address.lower())
+            if i is not None:
+                self.device_combo.setCurrentIndex(i)
 
         self.status_signal.emit(f"scan done: {len(items)} device(s)")
 
@@ -432,8 +615,17 @@ class MainWindow(QMainWindow):
             return
 
         # reset stats (only on manual connect)
-        self.samples = []
-        self.bin_counts = {}
+        with self._pending_lock:
+            self._pending_ts.clear()
+            self._pending_bpm.clear()
+        self._seq = 0
+        self._count = 0
+        self._last_xrange_t = 0.0
+        self._last_yrange = (0.0, 0.0)
+        self._min_dq.clear()
+        self._max_dq.clear()
+        self._bins[:] = 0
+        self._best_bin = -1
         self.total_samples = 0
         self.battery = None
         self.battery_lbl.setText("Battery: —")
@@ -445,17 +637,14 @@ class MainWindow(QMainWindow):
             self.log_path = default_out_path()
         self.log_path.parent.mkdir(parents=True, exist_ok=True)
 
+        if self.log_writer:
+            # left open by an interrupted reconnect
+            self._close_log_writer()
+
         try:
-            existed = self.log_path.exists() and self.log_path.stat().st_size > 0
-            mode = "a" if existed else "w"
-            self.log_file = open(self.log_path, mode, newline="", encoding="utf-8")
-            self.log_writer = csv.writer(self.log_file)
-            if not existed:
-                self.log_writer.writerow(["timestamp", "bpm", "battery_percent"])
-                self.log_file.flush()
+            self.log_writer = CsvLogWriter(self.log_path, on_error=self.status_signal.emit)
         except Exception as e:
             self.status_signal.emit(f"log file error: {e}")
-            self.log_file = None
             self.log_writer = None
             return
 
@@ -469,6 +658,7 @@ class MainWindow(QMainWindow):
 
         # save address for next launches (auto-fill)
         self.settings.setValue("last_address", address)
+        self.saved_address = address
 
         self.status_signal.emit(f"connected: {address} (logging → {self.log_path})")
 
@@ -506,31 +696,39 @@ class MainWindow(QMainWindow):
         self.client = None
         self.connected_address = None
 
-        if close_log and self.log_file:
-            try:
-                self.log_file.close()
-            except Exception:
-                pass
-            self.log_file = None
-            self.log_writer = None
+        if close_log and self.log_writer:
+            self._close_log_writer()
 
         self.btn_connect.setEnabled(True)
         self.btn_disconnect.setEnabled(False)
 
+    def _close_log_writer(self):
+        # samples still waiting for the render timer belong in this log
+        self._render()
+        try:
+            self.log_writer.close()
+        except Exception:
+            pass
+        self.log_writer = None
+
     def closeEvent(self, event):
         # graceful disconnect on window close
         if self.client:
             asyncio.create_task(self._disconnect_internal())
+        # the loop may stop before that task runs: write out the log now
+        if self.log_writer:
+            self._close_log_writer()
         super().closeEvent(event)
 
 
 def main():
+    configure_plot_backend()
+    h64_analytics.warm_up()
+
     app = QApplication(sys.argv)
     loop = QEventLoop(app)
     asyncio.set_event_loop(loop)
 
-    pg.setConfigOptions(antialias=True)
-
     win = MainWindow()
     win.show()
 
@@ -1,10 +1,11 @@
 import argparse
 import asyncio
-import csv
+import struct
+import time
 from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
-from typing import Optional, Dict, Tuple, Any, List
+from typing import Optional, Dict, Tuple, Any, Callable, FrozenSet
 
 from bleak import BleakClient, BleakScanner
 
@@ -12,18 +13,20 @@ HR_SERVICE = "0000180d-0000-1000-8000-00805f9b34fb"
 HR_CHAR    = "00002a37-0000-1000-8000-00805f9b34fb"
 BAT_CHAR   = "00002a19-0000-1000-8000-00805f9b34fb"
 
+# Fixed schema, no field ever needs quoting; \r\n line ends as csv.writer writes them
+CSV_HEADER = "timestamp,bpm,battery_percent\r\n"
+
+_u16_le = struct.Struct("<H").unpack_from
+
 
 def parse_hr(data: bytearray) -> Optional[int]:
     """Parse BLE Heart Rate Measurement (0x2A37)."""
-    if not data or len(data) < 2:
+    n = len(data) if data else 0
+    if n < 2:
         return None
-    flags = data[0]
-    is_u16 = (flags & 0x01) != 0
-    if not is_u16:
-        return int(data[1])
-    if len(data) < 3:
-        return None
-    return int(data[1] | (data[2] << 8))
+    if data[0] & 0x01:   # flags: bpm is uint16
+        return _u16_le(data, 1)[0] if n >= 3 else None
+    return data[1]
 
 
 @dataclass
@@ -31,37 +34,74 @@ class LogState:
     battery: Optional[int] = None
 
 
-async def scan(timeout: float) -> Dict[str, Tuple[Any, Any]]:
+class IsoSecondFormatter:
+    """Formats epoch seconds as local ISO time (seconds), reusing the string within the same second."""
+
+    def __init__(self) -> None:
+        self._sec = -1
+        self._iso = ""
+
+    def format(self, ts: float) -> str:
+        sec = int(ts)
+        if sec != self._sec:
+            self._iso = datetime.fromtimestamp(sec).isoformat(timespec="seconds")
+            self._sec = sec
+        return self._iso
+
+
+async def scan(
+    timeout: float,
+    predicate: Optional[Callable[[Any, Any], bool]] = None,
+) -> Dict[str, Tuple[Any, Any]]:
     """
-    Returns dict[address] = (device, advertisement_data_or_None)
+    Returns dict[address] = (device, advertisement_data)
     Works across bleak backends without using device.metadata.
+    If predicate(device, adv_data) is given, stops as soon as it returns True.
     """
-    found: Dict[str, Tuple[Any, Any]] = {}
-
-    def cb(device, adv_data):
-        # device.address exists; adv_data may be None depending on backend
-        found[device.address] = (device, adv_data)
+    if predicate is None:
+        return await BleakScanner.discover(timeout=timeout, return_adv=True)
 
-    scanner = BleakScanner(detection_callback=cb)
-    await scanner.start()
+    found: Dict[str, Tuple[Any, Any]] = {}
     try:
-        await asyncio.sleep(timeout)
-    finally:
-        await scanner.stop()
+        async with asyncio.timeout(timeout):
+            async with BleakScanner() as scanner:
+                async for device, adv_data in scanner.advertisement_data():
+                    found[device.address] = (device, adv_data)
+                    if predicate(device, adv_data):
+                        break
+    except TimeoutError:
+        pass
 
     return found
 
 
-def service_uuids_lower(adv: Any) -> List[str]:
+def service_uuids_lower(adv: Any) -> FrozenSet[str]:
     if adv is None:
-        return []
+        return frozenset()
     uuids = getattr(adv, "service_uuids", None) or []
-    return [u.lower() for u in uuids]
+    # most backends already report lowercase UUIDs
+    return frozenset(u if u.islower() else u.lower() for u in uuids)
+
+
+def has_hr_service(adv: Any) -> bool:
+    """True if the advertisement lists the Heart Rate service; lowercases only on mismatch."""
+    for u in getattr(adv, "service_uuids", None) or ():
+        if u == HR_SERVICE or u.lower() == HR_SERVICE:
+            return True
+    return False
 
 
 async def find_device(name_hint: Optional[str], address: Optional[str], timeout: float):
     print("Scanning... (wear the strap so H64 is awake)")
-    found = await scan(timeout=timeout)
+
+    def is_target(dev, adv) -> bool:
+        if address:
+            return dev.address.lower() == address.strip().lower()
+        if not has_hr_service(adv):
+            return False
+        return not name_hint or name_hint.lower() in (dev.name or "").lower()
+
+    found = await scan(timeout=timeout, predicate=is_target)
 
     # If user provided exact address - prefer it
     if address:
@@ -76,7 +116,7 @@ async def find_device(name_hint: Optional[str], address: Optional[str], timeout:
 
     # 1) Prefer devices advertising Heart Rate Service
     for _, (dev, adv) in found.items():
-        if HR_SERVICE in service_uuids_lower(adv):
+        if has_hr_service(adv):
             if name_hint and (dev.name or "").lower().find(name_hint.lower()) == -1:
                 continue
             return dev
@@ -101,6 +141,7 @@ async def run_logger(
     address: Optional[str],
     out_path: Path,
     scan_timeout: float,
+    flush_every: int = 0,
 ) -> None:
     dev = await find_device(name_hint=name_hint, address=address, timeout=scan_timeout)
     if not dev:
@@ -114,15 +155,19 @@ async def run_logger(
     out_path.parent.mkdir(parents=True, exist_ok=True)
 
     state = LogState()
+    iso = IsoSecondFormatter()
 
     with out_path.open("w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerow(["timestamp", "bpm", "battery_percent"])
+        f.write(CSV_HEADER)
+        rows = 0
 
         def write_row(bpm: int) -> None:
-            now = datetime.now().isoformat(timespec="seconds")
-            writer.writerow([now, bpm, "" if state.battery is None else state.battery])
-            f.flush()
+            nonlocal rows
+            now = iso.format(time.time())
+            f.write(f"{now},{bpm},{'' if state.battery is None else state.battery}\r\n")
+            rows += 1
+            if flush_every and rows % flush_every == 0:
+                f.flush()
             print(f"{now}  BPM={bpm}  Battery={state.battery if state.battery is not None else '-'}%")
 
         async with BleakClient(dev.address) as client:
@@ -168,11 +213,11 @@ async def list_devices(scan_timeout: float) -> None:
 
     for addr, (dev, adv) in found.items():
         uuids = service_uuids_lower(adv)
-        mark = "  *HR*" if HR_SERVICE in uuids else ""
+        mark = "  *HR*" if has_hr_service(adv) else ""
         name = dev.name or ""
         print(f"{addr}  name={name!r}{mark}")
         if uuids:
-            print(f"      services={uuids}")
+            print(f"      services={sorted(uuids)}")
 
 
 def main() -> None:
@@ -182,6 +227,12 @@ def main() -> None:
     p.add_argument("--address", default=None, help="Exact BLE address to connect (optional)")
     p.add_argument("--out", default=None, help="Output CSV path (default: logs/h64_hr_log_YYYYMMDD_HHMMSS.csv)")
     p.add_argument("--scan-timeout", type=float, default=12.0, help="BLE scan timeout seconds (default: 12)")
+    p.add_argument(
+        "--flush-every",
+        type=int,
+        default=0,
+        help="Flush CSV to disk every N rows (default: 0 = only on exit)",
+    )
     args = p.parse_args()
 
     out_path = Path(args.out) if args.out else default_out_path()
@@ -196,6 +247,7 @@ def main() -> None:
                     address=args.address,
                     out_path=out_path,
                     scan_timeout=args.scan_timeout,
+                    flush_every=args.flush_every,
                 )
             )
     except KeyboardInterrupt: